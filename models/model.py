@@ -2,24 +2,17 @@ from __future__ import division, print_function, unicode_literals
 
 import json
 import math
-import operator
 import os
 import random
 from io import open
-from queue import PriorityQueue  # for py3
-from functools import reduce  # for py3
+from typing import List, Optional
 
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch import optim
 
 import models.policy as policy
-# pp added: used for PriorityQueue python3, add an extra para in .put() method
-from itertools import count
-
-unique = count()
 
 from utils.util import SOS_token, EOS_token, PAD_token, detected_device
 
@@ -34,30 +27,6 @@ default_device = detected_device
 # use_moe_loss = True # inner models weighting loss
 # learn_loss_weight = True
 # use_moe_model = True # inner models structure partition
-#
-# pp added
-# @total_ordering
-# class PriorityElem:
-#     def __init__(self, elem_to_wrap):
-#         self.wrapped_elem = elem_to_wrap
-#
-#     def __lt__(self, other):
-#         return self.wrapped_elem.priority < other.wrapped_elem.priority
-
-# Shawn beam search decoding
-class BeamSearchNode(object):
-    def __init__(self, h, prevNode, wordid, logp, leng):
-        self.h = h
-        self.prevNode = prevNode
-        self.wordid = wordid
-        self.logp = logp
-        self.leng = leng
-
-    def eval(self, repeatPenalty, tokenReward, scoreTable, alpha=1.0):
-        reward = 0
-        alpha = 1.0
-
-        return self.logp / float(self.leng - 1 + 1e-6) + alpha * reward
 
 
 def init_lstm(cell, gain=1):
@@ -100,8 +69,19 @@ def whatCellType(input_size, hidden_size, cell_type, dropout_rate):
         return cell
 
 
+def maybe_compile(fn, args):
+    '''
+    wrap fn with torch.compile when --compile is set and this torch provides it, otherwise hand fn back unchanged
+    dynamic shapes since batch size and source length change from batch to batch
+    '''
+    if getattr(args, 'compile', False) and hasattr(torch, 'compile'):
+        return torch.compile(fn, dynamic=True)
+    return fn
+
+
 class EncoderRNN(nn.Module):
-    def __init__(self, input_size, embedding_size, hidden_size, cell_type, depth, dropout, device=default_device):
+    def __init__(self, input_size, embedding_size, hidden_size, cell_type, depth, dropout, device=default_device,
+                 sparse=False):
         super(EncoderRNN, self).__init__()
         self.input_size = input_size
         self.hidden_size = hidden_size
@@ -112,7 +92,7 @@ class EncoderRNN(nn.Module):
         if 'bi' in cell_type:
             self.bidirectional = True
         padding_idx = 3
-        self.embedding = nn.Embedding(input_size, embedding_size, padding_idx=padding_idx)
+        self.embedding = nn.Embedding(input_size, embedding_size, padding_idx=padding_idx, sparse=sparse)
         # self.embedding = nn.Embedding(400, embedding_size, padding_idx=padding_idx)
         self.rnn = whatCellType(embedding_size, hidden_size,
                                 cell_type, dropout_rate=self.dropout)
@@ -121,38 +101,19 @@ class EncoderRNN(nn.Module):
     def forward(self, input_seqs, input_lens, hidden=None):
         """
         forward procedure. **No need for inputs to be sorted**
-        :param input_seqs: Variable of [T,B]
+        :param input_seqs: Variable of [B,T]
         :param hidden:
-        :param input_lens: *numpy array* of len for each input sequence
+        :param input_lens: list or cpu LongTensor of len for each input sequence
         :return:
         """
-        input_lens = np.asarray(input_lens)
-        input_seqs = input_seqs.transpose(0, 1)
-        # batch_size = input_seqs.size(1)
-        embedded = self.embedding(input_seqs)
-        embedded = embedded.transpose(0, 1)  # [B,T,E]
-        sort_idx = np.argsort(-input_lens)
-        # pp added
-        unsort_idx = np.argsort(sort_idx)
-        # unsort_idx = torch.LongTensor(np.argsort(sort_idx))
-        input_lens = input_lens[sort_idx]
-        # sort_idx = torch.LongTensor(sort_idx)
-        embedded = embedded[sort_idx].transpose(0, 1)  # [T,B,E]
-        packed = torch.nn.utils.rnn.pack_padded_sequence(embedded, input_lens)
+        embedded = self.embedding(input_seqs.t())  # [T,B,E]
+        # pack_padded_sequence sorts by length itself and the rnn hands back outputs and hidden in input order
+        packed = torch.nn.utils.rnn.pack_padded_sequence(embedded, input_lens, enforce_sorted=False)
         outputs, hidden = self.rnn(packed, hidden)
         outputs, _ = torch.nn.utils.rnn.pad_packed_sequence(outputs)
         if self.bidirectional:
-            outputs = outputs[:, :, :self.hidden_size] + outputs[:, :, self.hidden_size:]
-
-        outputs = outputs.transpose(0, 1)[unsort_idx].transpose(0, 1).contiguous()
-
-        if isinstance(hidden, tuple):
-            hidden = list(hidden)
-            hidden[0] = hidden[0].transpose(0, 1)[unsort_idx].transpose(0, 1).contiguous()
-            hidden[1] = hidden[1].transpose(0, 1)[unsort_idx].transpose(0, 1).contiguous()
-            hidden = tuple(hidden)
-        else:
-            hidden = hidden.transpose(0, 1)[unsort_idx].transpose(0, 1).contiguous()
+            max_len, batch_size = outputs.size(0), outputs.size(1)
+            outputs = outputs.view(max_len, batch_size, 2, self.hidden_size).sum(dim=2)
 
         return outputs, hidden
 
@@ -177,25 +138,90 @@ class Attn(nn.Module):
         :return
             attention energies in shape (B,T)
         '''
-        max_len = encoder_outputs.size(0)
-
-        H = hidden.repeat(max_len, 1, 1).transpose(0, 1)
+        H = hidden.transpose(0, 1)  # [1,B,H] -> [B,1,H], broadcast over T in score
         encoder_outputs = encoder_outputs.transpose(0, 1)  # [T,B,H] -> [B,T,H]
         attn_energies = self.score(H, encoder_outputs)  # compute attention score
         return F.softmax(attn_energies, dim=1).unsqueeze(1)  # normalize with softmax
 
     def score(self, hidden, encoder_outputs):
-        cat = torch.cat([hidden, encoder_outputs], 2)
-        energy = torch.tanh(self.attn(cat))  # [B*T*2H]->[B*T*H]
-        energy = energy.transpose(2, 1)  # [B*H*T]
-        v = self.v.repeat(encoder_outputs.data.shape[0], 1).unsqueeze(1)  # [B*1*H]
-        energy = torch.bmm(v, energy)  # [B*1*T]
-        return energy.squeeze(1)  # [B*T]
+        # attn([h; e]) == W_h h + b + W_e e, no [B*T*2H] concat needed
+        energy = F.linear(encoder_outputs, self.attn.weight[:, self.hidden_size:]) + \
+                 F.linear(hidden, self.attn.weight[:, :self.hidden_size], self.attn.bias)
+        energy = torch.tanh(energy)  # [B*T*H]
+        return torch.einsum('h,bth->bt', [self.v, energy])  # [B*T]
+
+
+@torch.jit.script
+def decode_step(embedded, h, c, encoder_outputs, enc_key, attn_weight_h, attn_bias, v, w_ih, w_hh, b_ih, b_hh,
+                cell_type: str):
+    '''
+    one step of the bahdanau attention decoder, written with cell ops so that it can be unrolled in TorchScript
+    :param embedded: embedded input words [B*G,E]
+    :param h, c: previous hidden (and cell) state [B*G,H]; c is ignored unless cell_type is lstm
+    :param encoder_outputs: [B,T,H], shared by the G consecutive rows of each group, e.g. the beams of a turn
+    :param enc_key: encoder half of the attention projection [B,T,H], see SeqAttnDecoderRNN.prepare
+    :return: new hidden and cell state [B*G,H]
+    '''
+    n_groups = enc_key.size(0)
+    # SCORE 3: attn([h_t; e]) == W_h h_t + b + W_e e, only the decoder half changes between steps
+    energy = enc_key.unsqueeze(1) + F.linear(h, attn_weight_h, attn_bias).view(n_groups, -1, 1, enc_key.size(2))
+    energy = torch.tanh(energy)  # [B,G,T,D]
+    attn_weights = F.softmax(torch.einsum('h,bgth->bgt', [v, energy]), dim=2)  # [B,G,T]
+
+    # getting context, the encoder outputs are broadcast over the group instead of being copied
+    context = torch.einsum('bgt,bth->bgh', [attn_weights, encoder_outputs]).reshape(h.size(0), -1)  # [B*G,H]
+
+    # Combine embedded input word and attended context, run through RNN
+    rnn_input = torch.cat((embedded, context), 1)
+    if cell_type == 'lstm':
+        h, c = torch.lstm_cell(rnn_input, [h, c], w_ih, w_hh, b_ih, b_hh)
+    elif cell_type == 'gru':
+        h = torch.gru_cell(rnn_input, h, w_ih, w_hh, b_ih, b_hh)
+    else:
+        h = torch.rnn_tanh_cell(rnn_input, h, w_ih, w_hh, b_ih, b_hh)
+    return h, c
+
+
+@torch.jit.script
+def decode_loop(decoder_input, h, c, target_tensor: Optional[torch.Tensor], teacher_mask, encoder_outputs, enc_key,
+                embedding_weight, attn_weight_h, attn_bias, v, w_ih, w_hh, b_ih, b_hh, out_weight, out_bias,
+                cell_type: str, sparse: bool = False):
+    '''
+    unroll decode_step over len(teacher_mask) steps without going back to python
+    :param decoder_input: first input words [B]
+    :param teacher_mask: bool [T], feed target_tensor[:, t] as next input where True, else the argmax
+    :return: log-probabilities [B,T,V], hidden states [B,T,H] and the last hidden and cell state
+    '''
+    batch_size = decoder_input.size(0)
+    target_length = teacher_mask.size(0)
+    # without targets the mask is all False, any words of the right shape do as the never taken branch
+    if target_tensor is None:
+        teacher_input = decoder_input.unsqueeze(1).expand(batch_size, target_length)
+    else:
+        teacher_input = target_tensor
+    proba: List[torch.Tensor] = []
+    hidd: List[torch.Tensor] = []
+    for t in range(target_length):
+        embedded = F.embedding(decoder_input, embedding_weight, sparse=sparse)  # [B,E]
+        h, c = decode_step(embedded, h, c, encoder_outputs, enc_key, attn_weight_h, attn_bias, v,
+                           w_ih, w_hh, b_ih, b_hh, cell_type)
+        decoder_output = F.log_softmax(F.linear(h, out_weight, out_bias), dim=1)  # [B,V]
+        proba.append(decoder_output)
+        hidd.append(h)
+        # Teacher forcing where teacher_mask[t], else the argmax detached from history; no host sync
+        decoder_input = torch.where(teacher_mask[t], teacher_input[:, t], decoder_output.topk(1)[1].view(-1).detach())
+    return torch.stack(proba, dim=1), torch.stack(hidd, dim=1), h, c
 
 
 class SeqAttnDecoderRNN(nn.Module):
+    # submodules that int8 dynamic quantization may replace, see Model.prepare_for_inference;
+    # none here, the decode loop reads the raw weights of every layer
+    quantizable = ()
+    # forward takes B encoder outputs for B*G hypotheses, see decode_step and Model.beam_decode
+    grouped_attention = True
+
     def __init__(self, embedding_size, hidden_size, output_size, cell_type, dropout_p=0.1, max_length=30,
-                 device=default_device):
+                 device=default_device, sparse=False):
         super(SeqAttnDecoderRNN, self).__init__()
         # Define parameters
         self.hidden_size = hidden_size
@@ -206,11 +232,12 @@ class SeqAttnDecoderRNN(nn.Module):
         self.device = device
 
         # Define layers
-        self.embedding = nn.Embedding(output_size, embedding_size)
+        self.embedding = nn.Embedding(output_size, embedding_size, sparse=sparse)
         self.dropout = nn.Dropout(dropout_p)
 
         if 'bi' in cell_type:  # we dont need bidirectionality in decoding
             cell_type = cell_type.strip('bi')
+        self.cell_type = cell_type
         self.rnn = whatCellType(embedding_size + hidden_size, hidden_size, cell_type, dropout_rate=self.dropout_p)
         self.out = nn.Linear(hidden_size, output_size)
 
@@ -223,45 +250,76 @@ class SeqAttnDecoderRNN(nn.Module):
         self.v = nn.Parameter(torch.rand(hidden_size))
         stdv = 1. / math.sqrt(self.v.size(0))
         self.v.data.normal_(mean=0, std=stdv)
+        self._enc_key = None
 
-    def forward(self, input, hidden, encoder_outputs, mask_tensor=None):
+    def prepare(self, encoder_outputs):
+        """Project the encoder outputs [T,B,H] through their half of self.attn once per decoding."""
+        self._enc_key = F.linear(encoder_outputs.transpose(0, 1), self.attn.weight[:, self.hidden_size:])  # [B,T,H]
+        return self._enc_key
+
+    def select_prepared(self, index):
+        """Pick batch rows of what prepare computed, e.g. to replicate it per beam instead of re-projecting."""
+        self._enc_key = self._enc_key.index_select(0, index)
+        return self._enc_key
+
+    def rnn_weights(self):
+        # single layer rnn, run through the cell ops in decode_step
+        return self.rnn.weight_ih_l0, self.rnn.weight_hh_l0, self.rnn.bias_ih_l0, self.rnn.bias_hh_l0
+
+    def split_hidden(self, hidden):
+        # [1,B,H] (tuple for lstm) -> h, c in [B,H]; c is a placeholder for gru/rnn
         if isinstance(hidden, tuple):
-            h_t = hidden[0]
-        else:
-            h_t = hidden
+            return hidden[0].squeeze(0), hidden[1].squeeze(0)
+        h_t = hidden.squeeze(0)
+        return h_t, h_t
+
+    def merge_hidden(self, h_t, c_t):
+        if self.cell_type == 'lstm':
+            return h_t.unsqueeze(0), c_t.unsqueeze(0)
+        return h_t.unsqueeze(0)
+
+    def forward(self, input, hidden, encoder_outputs, mask_tensor=None):
+        h_t, c_t = self.split_hidden(hidden)
         encoder_outputs = encoder_outputs.transpose(0, 1)
-        embedded = self.embedding(input)  # .view(1, 1, -1)
+        embedded = self.embedding(input.reshape(-1))  # [B,1] -> [B,E]
         # embedded = F.dropout(embedded, self.dropout_p)
 
-        # SCORE 3
-        max_len = encoder_outputs.size(1)
-        h_t = h_t.transpose(0, 1)  # [1,B,D] -> [B,1,D]
-        h_t = h_t.repeat(1, max_len, 1)  # [B,1,D]  -> [B,T,D]
-        energy = self.attn(torch.cat((h_t, encoder_outputs), 2))  # [B,T,2D] -> [B,T,D]
-        energy = torch.tanh(energy)
-        energy = energy.transpose(2, 1)  # [B,H,T]
-        v = self.v.repeat(encoder_outputs.size(0), 1).unsqueeze(1)  # [B,1,H]
-        energy = torch.bmm(v, energy)  # [B,1,T]
-        attn_weights = F.softmax(energy, dim=2)  # [B,1,T]
+        h_t, c_t = decode_step(embedded, h_t, c_t, encoder_outputs, self._enc_key,
+                               self.attn.weight[:, :self.hidden_size], self.attn.bias, self.v,
+                               *self.rnn_weights(), cell_type=self.cell_type)
 
-        # getting context
-        context = torch.bmm(attn_weights, encoder_outputs)  # [B,1,H]
+        output = F.log_softmax(self.out(h_t), dim=1)  # (B,H)->(B,V)
+        return output, self.merge_hidden(h_t, c_t)  # , attn_weights
 
-        # context = torch.bmm(attn_weights.unsqueeze(0), encoder_outputs.unsqueeze(0)) #[B,1,H]
-        # Combine embedded input word and attended context, run through RNN
-        rnn_input = torch.cat((embedded, context), 2)
-        rnn_input = rnn_input.transpose(0, 1)
+    def decode_sequence(self, decoder_input, hidden, encoder_outputs, target_tensor, teacher_mask):
+        """Run the whole teacher-forced (or greedy) decoding loop in a single TorchScript call.
+        :param decoder_input: tensor[B,1] of SOS tokens
+        :param teacher_mask: bool tensor[T], see Model.teacher_forcing_mask
+        :return: log-probabilities [B,T,V], hidden states [B,T,H] and the last decoder hidden
+        """
+        h_t, c_t = self.split_hidden(hidden)
+        proba, hidd, h_t, c_t = decode_loop(decoder_input.reshape(-1), h_t, c_t, target_tensor, teacher_mask,
+                                            encoder_outputs.transpose(0, 1), self._enc_key, self.embedding.weight,
+                                            self.attn.weight[:, :self.hidden_size], self.attn.bias, self.v,
+                                            *self.rnn_weights(),
+                                            self.out.weight, self.out.bias, cell_type=self.cell_type,
+                                            sparse=self.embedding.sparse)
+        return proba, hidd, self.merge_hidden(h_t, c_t)
 
-        output, hidden = self.rnn(rnn_input, hidden)
-        output = output.squeeze(0)  # (1,B,V)->(B,V)
 
-        output = F.log_softmax(self.out(output), dim=1)
-        return output, hidden  # , attn_weights
+def live_rows(x, src, dim):
+    # rows src of x along dim followed by one all-zero row, see MoESeqAttnDecoderRNN.token_routing
+    return torch.cat((x.index_select(dim, src), torch.zeros_like(x.narrow(dim, 0, 1))), dim)
 
 
 class MoESeqAttnDecoderRNN(nn.Module):
+    # called as modules; attn and attn_f are sliced into their halves so they keep float weights
+    quantizable = ('rnn', 'out', 'moe_fc')
+    # the experts attend over one encoder output per hypothesis, beam search replicates them
+    grouped_attention = False
+
     def __init__(self, embedding_size, hidden_size, output_size, cell_type, k=1, dropout_p=0.1, max_length=30,
-                 args=None, device=default_device):
+                 args=None, device=default_device, sparse=False):
         super(MoESeqAttnDecoderRNN, self).__init__()
         # Define parameters
         self.hidden_size = hidden_size
@@ -276,7 +334,7 @@ class MoESeqAttnDecoderRNN(nn.Module):
         self.future_size = self.output_size
 
         # Define layers
-        self.embedding = nn.Embedding(output_size, embedding_size)
+        self.embedding = nn.Embedding(output_size, embedding_size, sparse=sparse)
         self.dropout = nn.Dropout(dropout_p)
 
         if 'bi' in cell_type:  # we dont need bidirectionality in decoding
@@ -307,36 +365,58 @@ class MoESeqAttnDecoderRNN(nn.Module):
         self.v.data.normal_(mean=0, std=stdv)
 
         # self.attn_dec_hid = Attn(self.method, hidden_size, self.device)
-
-    def expert_forward(self, input, hidden, encoder_outputs):
+        self._enc_key = None
+        self._fut_key = None
+        self._routing = None  # see token_routing
+        # the attention + cell step is a chain of small elementwise ops and matmuls, let the compiler fuse it
+        self.expert_forward = maybe_compile(self.expert_forward, args)
+
+    def prepare(self, encoder_outputs):
+        """Project the encoder outputs [T,B,H] through their half of self.attn once per decoding."""
+        self._enc_key = F.linear(encoder_outputs.transpose(0, 1), self.attn.weight[:, self.hidden_size:])  # [B,T,H]
+        self._fut_key = None  # built by the first prospectiveMoE step, see future_key
+        self._routing = None
+        return self._enc_key
+
+    def select_prepared(self, index):
+        """Pick batch rows of what prepare computed, e.g. to replicate it per beam instead of re-projecting."""
+        self._enc_key = self._enc_key.index_select(0, index)
+        if self._fut_key is not None:
+            self._fut_key = self._fut_key.index_select(0, index)
+        return self._enc_key
+
+    def future_key(self, encoder_outputs, dec_hidd_with_future):
+        """Encoder and future part of self.attn_f [B,T,H]; the future info is fixed for a whole decoding."""
+        if self._fut_key is None:
+            max_len = encoder_outputs.size(0)
+            weight = self.attn_f.weight
+            self._fut_key = F.linear(encoder_outputs.transpose(0, 1), weight[:, self.hidden_size:2 * self.hidden_size]) + \
+                            F.linear(dec_hidd_with_future[:max_len].transpose(0, 1), weight[:, 2 * self.hidden_size:])
+        return self._fut_key
+
+    def expert_forward(self, input, hidden, encoder_outputs, enc_key):
         if isinstance(hidden, tuple):
             h_t = hidden[0]
         else:
             h_t = hidden
         encoder_outputs = encoder_outputs.transpose(0, 1)
 
-        embedded = self.embedding(input)  # .view(1, 1, -1)
+        embedded = self.embedding(input.reshape(1, -1))  # [B,1] -> [1,B,E], already time-major for the rnn
         # embedded = F.dropout(embedded, self.dropout_p)
 
-        # SCORE 3
-        max_len = encoder_outputs.size(1)
+        # SCORE 3: attn([h_t; e]) == W_h h_t + b + W_e e, the encoder half comes from prepare
         h_t_reshaped = h_t.unsqueeze(0) if len(h_t.size()) == 2 else h_t  # pp added: make sure h_t is [1,B,D]
         h_t = h_t_reshaped.transpose(0, 1)  # [1,B,D] -> [B,1,D]
-        h_t = h_t.repeat(1, max_len, 1)  # [B,1,D]  -> [B,T,D]
 
-        energy = self.attn(torch.cat((h_t, encoder_outputs), 2))  # [B,T,2D] -> [B,T,D]
+        energy = enc_key + F.linear(h_t, self.attn.weight[:, :self.hidden_size], self.attn.bias)  # [B,T,D]
         energy = torch.tanh(energy)
-        energy = energy.transpose(2, 1)  # [B,H,T]
-        v = self.v.repeat(encoder_outputs.size(0), 1).unsqueeze(1)  # [B,1,H]
-        energy = torch.bmm(v, energy)  # [B,1,T]
-        attn_weights = F.softmax(energy, dim=2)  # [B,1,T]
+        attn_weights = F.softmax(torch.einsum('h,bth->bt', [self.v, energy]), dim=1)  # [B,T]
 
         # getting context
-        context = torch.bmm(attn_weights, encoder_outputs)  # [B,1,H]
+        context = torch.einsum('bt,bth->bh', [attn_weights, encoder_outputs]).unsqueeze(0)  # [1,B,H]
 
         # Combine embedded input word and attended context, run through RNN
-        rnn_input = torch.cat((embedded, context), 2)
-        rnn_input = rnn_input.transpose(0, 1)
+        rnn_input = torch.cat((embedded, context), 2)  # [1,B,E+H]
 
         # pp added
         new_hid = h_t_reshaped
@@ -350,7 +430,7 @@ class MoESeqAttnDecoderRNN(nn.Module):
         output = output.squeeze(0)  # (1,B,H)->(Batu,H)
 
         output = F.log_softmax(self.out(output), dim=1)  # self.out(output)[batch, out_vocab]
-        return output, hidden, embedded.transpose(0, 1)  # , attn_weights
+        return output, hidden, embedded  # , attn_weights
 
     def moe_layer(self, decoder_output_list, decoder_hidden_list, embedded_list, gamma_expert):
         # output
@@ -378,57 +458,73 @@ class MoESeqAttnDecoderRNN(nn.Module):
         norm_weights = torch.sum(moe_weights, dim=1)
         norm_weights = norm_weights.unsqueeze(1)
         moe_weights = torch.div(moe_weights, norm_weights)  # [B, I]
-        moe_weights = moe_weights.permute(1, 0).unsqueeze(-1)  # [I, B, 1]; debug:[8,2,1]
+        moe_weights = moe_weights.permute(1, 0)  # [I, B]; debug:[8,2]
         # MOE weights computation + normalization ------ End
         # output
-        moe_weights_output = moe_weights.expand(-1, -1, decoder_output_list[0].size(-1))  # [I, B, V]; [8,2,400]
         decoder_output_tensor = torch.stack(decoder_output_list)  # [I, B, V]
-        output = decoder_output_tensor.mul(moe_weights_output).sum(0)  # [B, V]; [2, 400]
+        output = torch.einsum('ib,ibv->bv', [moe_weights, decoder_output_tensor])  # [B, V]; [2, 400]
         # weighting
         output = gamma_expert * output + (1 - gamma_expert) * chair_dec_out  # [2, 400]
-        # hidden
-        moe_weights_hidden = moe_weights.expand(-1, -1, decoder_hidden_list[0][0].size(-1))  # [I, B, H]; [8,2,5]
-        if isinstance(decoder_hidden_list[0], tuple):  # for lstm
-            stack_dec_hid = torch.stack([a.squeeze(0) for a, b in decoder_hidden_list]), torch.stack(
-                [b.squeeze(0) for a, b in decoder_hidden_list])  # [I, B, H]
-            hidden = stack_dec_hid[0].mul(moe_weights_hidden).sum(0).unsqueeze(0), stack_dec_hid[1].mul(
-                moe_weights_hidden).sum(0).unsqueeze(0)  # [B, H]
-            hidden = gamma_expert * hidden[0] + (1 - gamma_expert) * chair_dec_hid[0], gamma_expert * hidden[1] + (
-                        1 - gamma_expert) * chair_dec_hid[1]
+
+        # hidden, each state (h, and c for lstm) is stacked once and weighted the same way as the output
+        def mix(states):
+            stack_dec_hid = torch.stack(states)  # [I, 1, B, H]
+            hidden = torch.einsum('ib,ilbh->lbh', [moe_weights, stack_dec_hid])  # [1, B, H]
+            return gamma_expert * hidden + (1 - gamma_expert) * states[0]
+
+        if isinstance(chair_dec_hid, tuple):  # for lstm
+            hidden = tuple(mix(list(states)) for states in zip(*decoder_hidden_list))
         else:  # for gru
-            stack_dec_hid = torch.stack([a.squeeze(0) for a in decoder_hidden_list])
-            hidden = stack_dec_hid[0].mul(moe_weights_hidden).sum(0).unsqueeze(0)
-            hidden = gamma_expert * hidden[0] + (1 - gamma_expert) * chair_dec_hid[0]
-            hidden = hidden.unsqueeze(0)
-            # print('hidden=', hidden.size())
+            hidden = mix(decoder_hidden_list)
         return output, hidden  # output[B, V] -- [2, 400] ; hidden[1, B, H] -- [1, 2, 5]
 
+    def token_routing(self, mask_tensor, encoder_outputs):
+        """Live rows of the tokenMoE frame and their encoder outputs and keys. They only depend on the mask, the
+        encoder outputs and the prepared keys, so they are built once per decoding and again after the decoding
+        loop selects other batch rows, instead of at every step."""
+        routing = self._routing
+        if routing is not None and routing[0] is mask_tensor and routing[1] is encoder_outputs \
+                and routing[2] is self._enc_key:
+            return routing[3:]
+        batch_size = encoder_outputs.size(1)
+        masks = torch.cat((torch.zeros_like(mask_tensor[:1]), mask_tensor)).bool().view(-1)  # [(k+1)*B]
+        live = masks.logical_not().nonzero().squeeze(-1)  # rows whose turn actually has the intent
+        src = live % batch_size  # turn of each live row
+        # a masked row gets all-zero input (word, hidden and encoder outputs), so one shared null row,
+        # appended after the live ones, gives the output of every masked row
+        n_live = live.size(0)
+        pos = torch.full_like(masks, n_live, dtype=torch.long)  # row of the compact batch each frame row reads
+        pos = pos.index_copy(0, live, torch.arange(n_live, device=live.device))
+        encoder_outputs_live = live_rows(encoder_outputs, src, 1)  # [T, L+1, H]
+        enc_key_live = live_rows(self._enc_key, src, 0)  # [L+1, T, H]
+        self._routing = (mask_tensor, encoder_outputs, self._enc_key, src, pos, encoder_outputs_live, enc_key_live)
+        return self._routing[3:]
+
     def tokenMoE(self, decoder_input, decoder_hidden, encoder_outputs, mask_tensor):
         # decoder_input[batch, 1]; decoder_hidden: tuple element is a tensor[1, batch, hidden], encoder_outputs[maxlen_target, batch, hidden]
         # n = len(self.intent_list) # how many intents do we have
-        output_c, hidden_c, embedded_c = self.expert_forward(input=decoder_input, hidden=decoder_hidden,
-                                                             encoder_outputs=encoder_outputs)
-        decoder_output_list, decoder_hidden_list, embedded_list = [output_c], [hidden_c], [embedded_c]
-        # decoder_output_list, decoder_hidden_list, embedded_list = [], [], []
-        # count = 0
-        for mask in mask_tensor:  # each intent has a mask [Batch, 1]
-            decoder_input_k = decoder_input.clone().masked_fill_(mask,
-                                                                 value=PAD_model)  # if assigned PAD_token it will count loss
-            if isinstance(decoder_hidden, tuple):
-                decoder_hidden_k = tuple(map(lambda x: x.clone().masked_fill_(mask, value=PAD_model), decoder_hidden))
-            else:
-                decoder_hidden_k = decoder_hidden.clone().masked_fill_(mask, value=PAD_model)
-            encoder_outputs_k = encoder_outputs.clone().masked_fill_(mask, value=PAD_model)
-            # test if there's someone not all PADDED
-            # if torch.min(decoder_input_k)!=PAD_token or torch.min(decoder_hidden_k[0])!=PAD_token or torch.min(decoder_hidden_k[1])!=PAD_token or torch.min(encoder_outputs_k)!=PAD_token:
-            # print(decoder_input_k, '\n', decoder_hidden_k,'\n', encoder_outputs_k)
-            # count += 1
-            output_k, hidden_k, embedded_k = self.expert_forward(input=decoder_input_k, hidden=decoder_hidden_k,
-                                                                 encoder_outputs=encoder_outputs_k)
+        # the chair and every intent expert run as one batch, row block i of (k+1)*B belongs to expert i (0 is the chair)
+        batch_size = decoder_input.size(0)
+        src, pos, encoder_outputs_live, enc_key_live = self.token_routing(mask_tensor, encoder_outputs)
 
-            decoder_output_list.append(output_k)
-            decoder_hidden_list.append(hidden_k)
-            embedded_list.append(embedded_k)
+        decoder_input_live = live_rows(decoder_input, src, 0)  # [L+1, 1]; the null word is PAD_model
+        if isinstance(decoder_hidden, tuple):
+            decoder_hidden_live = tuple(live_rows(x, src, 1) for x in decoder_hidden)
+        else:
+            decoder_hidden_live = live_rows(decoder_hidden, src, 1)
+
+        output_live, hidden_live, embedded_live = self.expert_forward(input=decoder_input_live,
+                                                                      hidden=decoder_hidden_live,
+                                                                      encoder_outputs=encoder_outputs_live,
+                                                                      enc_key=enc_key_live)
+
+        # scatter back to the (k+1)*B frame, masked rows read the null row
+        decoder_output_list = list(output_live.index_select(0, pos).split(batch_size, dim=0))  # (k+1) * [B, V]
+        if isinstance(hidden_live, tuple):
+            decoder_hidden_list = list(zip(*[x.index_select(1, pos).split(batch_size, dim=1) for x in hidden_live]))
+        else:
+            decoder_hidden_list = list(hidden_live.index_select(1, pos).split(batch_size, dim=1))  # (k+1) * [1, B, H]
+        embedded_list = list(embedded_live.index_select(1, pos).split(batch_size, dim=1))
 
         # print('count=', count) # 10/31 will count for loss
         gamma_expert = self.args.gamma_expert
@@ -440,46 +536,42 @@ class MoESeqAttnDecoderRNN(nn.Module):
         # output = F.log_softmax(self.out(output), dim=1) # self.out(output)[batch, out_vocab]
         return decoder_output, decoder_hidden
 
-    def pros_expert_forward(self, input, hidden, encoder_outputs, dec_hidd_with_future):
+    def pros_expert_forward(self, input, hidden, encoder_outputs, fut_key):
         if isinstance(hidden, tuple):
             h_t = hidden[0]
         else:
             h_t = hidden
         encoder_outputs = encoder_outputs.transpose(0, 1)
 
-        embedded = self.embedding(input)  # .view(1, 1, -1)
+        embedded = self.embedding(input.reshape(1, -1))  # [B,1] -> [1,B,E], already time-major for the rnn
         # embedded = F.dropout(embedded, self.dropout_p)
 
         # SCORE 3
-        max_len = encoder_outputs.size(1)
         h_t0 = h_t.transpose(0, 1)  # [1,B,D] -> [B,1,D]
-        h_t = h_t0.repeat(1, max_len, 1)  # [B,1,D]  -> [B,T,D]
 
         # pp added: new attn
-        energy = self.attn_f(torch.cat((h_t, encoder_outputs, dec_hidd_with_future[:max_len].transpose(0, 1)), 2))  # [B,T,2D] -> [B,T,D]
+        # attn_f([h_t; e; f]) == W_h h_t + b + W_e e + W_f f, the encoder and future part come from future_key
+        energy = fut_key + F.linear(h_t0, self.attn_f.weight[:, :self.hidden_size], self.attn_f.bias)  # [B,T,D]
         energy = torch.tanh(energy)
-        energy = energy.transpose(2, 1)  # [B,H,T]
-        v = self.v.repeat(encoder_outputs.size(0), 1).unsqueeze(1)  # [B,1,H]
-        energy = torch.bmm(v, energy)  # [B,1,T]
-        attn_weights = F.softmax(energy, dim=2)  # [B,1,T]
+        attn_weights = F.softmax(torch.einsum('h,bth->bt', [self.v, energy]), dim=1)  # [B,T]
 
         # getting context
-        context = torch.bmm(attn_weights, encoder_outputs)  # [B,1,H]
+        context = torch.einsum('bt,bth->bh', [attn_weights, encoder_outputs]).unsqueeze(0)  # [1,B,H]
 
         # Combine embedded input word and attended context, run through RNN
-        rnn_input = torch.cat((embedded, context), 2)
-        rnn_input = rnn_input.transpose(0, 1)
+        rnn_input = torch.cat((embedded, context), 2)  # [1,B,E+H]
         output, hidden = self.rnn(rnn_input, hidden) # if self.args.rp_share_rnn else self.rnn_f(rnn_input, hidden)
         output = output.squeeze(0)  # (1,B,H)->(B,H)
 
         output = F.log_softmax(self.out(output), dim=1)  # self.out(output)[batch, out_vocab]
-        return output, hidden, embedded.transpose(0, 1)  # , attn_weights
+        return output, hidden, embedded  # , attn_weights
 
     def prospectiveMoE(self, decoder_input, decoder_hidden, encoder_outputs, mask_tensor, dec_hidd_with_future):
         # count = 1
         # print('count=', count)
+        fut_key = self.future_key(encoder_outputs, dec_hidd_with_future)
         output_c, hidden_c, embedded_c = self.pros_expert_forward(decoder_input, decoder_hidden, encoder_outputs,
-                                                                  dec_hidd_with_future)
+                                                                  fut_key)
         decoder_output_list, decoder_hidden_list, embedded_list = [output_c], [hidden_c], [embedded_c]
 
         for mask in mask_tensor:  # each intent has a mask [Batch, 1]
@@ -492,9 +584,9 @@ class MoESeqAttnDecoderRNN(nn.Module):
             else:
                 decoder_hidden_k = decoder_hidden.clone().masked_fill_(mask, value=PAD_model)
             encoder_outputs_k = encoder_outputs.clone().masked_fill_(mask, value=PAD_model)
-            dec_hidd_with_future_k = dec_hidd_with_future.clone().masked_fill_(mask, value=PAD_model)
+            fut_key_k = fut_key.masked_fill(mask.unsqueeze(-1), value=PAD_model)  # key of the masked inputs
             output_k, hidden_k, embedded_k = self.pros_expert_forward(decoder_input_k, decoder_hidden_k,
-                                                                      encoder_outputs_k, dec_hidd_with_future_k)
+                                                                      encoder_outputs_k, fut_key_k)
 
             decoder_output_list.append(output_k)
             decoder_hidden_list.append(hidden_k)
@@ -513,12 +605,16 @@ class MoESeqAttnDecoderRNN(nn.Module):
                 output, hidden = self.prospectiveMoE(input, hidden, encoder_outputs, mask_tensor, dec_hidd_with_future)
         else:
             pass
-            output, hidden, _ = self.expert_forward(input, hidden, encoder_outputs)
+            output, hidden, _ = self.expert_forward(input, hidden, encoder_outputs, self._enc_key)
         return output, hidden  # , mask_tensor  # , attn_weights
 
 
 class DecoderRNN(nn.Module):
-    def __init__(self, embedding_size, hidden_size, output_size, cell_type, dropout=0.1, device=default_device):
+    quantizable = ('rnn', 'out')
+    grouped_attention = True  # the encoder outputs are not used at all
+
+    def __init__(self, embedding_size, hidden_size, output_size, cell_type, dropout=0.1, device=default_device,
+                 sparse=False):
         super(DecoderRNN, self).__init__()
         self.device = device
         self.hidden_size = hidden_size
@@ -526,7 +622,8 @@ class DecoderRNN(nn.Module):
         padding_idx = 3
         self.embedding = nn.Embedding(num_embeddings=output_size,
                                       embedding_dim=embedding_size,
-                                      padding_idx=padding_idx
+                                      padding_idx=padding_idx,
+                                      sparse=sparse
                                       )
         if 'bi' in cell_type:  # we dont need bidirectionality in decoding
             cell_type = cell_type.strip('bi')
@@ -534,8 +631,15 @@ class DecoderRNN(nn.Module):
         self.dropout_rate = dropout
         self.out = nn.Linear(hidden_size, output_size)
 
+    def prepare(self, not_used):
+        # no attention, nothing to precompute from the encoder outputs
+        return None
+
+    def select_prepared(self, not_used):
+        return None
+
     def forward(self, input, hidden, not_used, mask_tensor=None):
-        embedded = self.embedding(input).transpose(0, 1)  # [B,1] -> [ 1,B, D]
+        embedded = self.embedding(input.reshape(1, -1))  # [B,1] -> [ 1,B, D]
         embedded = F.dropout(embedded, self.dropout_rate)
 
         output = embedded
@@ -558,6 +662,8 @@ class Model(nn.Module):
 
         self.output_lang_index2word = output_lang_index2word
         self.input_lang_index2word = input_lang_index2word
+        # the json dictionaries are keyed by str(index), decoding looks words up by int index
+        self.output_words = {int(index): word for index, word in output_lang_index2word.items()}
 
         self.output_lang_word2index = output_lang_word2index
         self.input_lang_word2index = input_lang_word2index
@@ -591,10 +697,18 @@ class Model(nn.Module):
         self.teacher_forcing_ratio = args.teacher_ratio
         self.vocab_size = args.vocab_size
         self.epsln = 10E-5
+        # first decoder input, expanded to [batch, 1] instead of being rebuilt on every call
+        self.register_buffer('sos_input', torch.full((1, 1), SOS_token, dtype=torch.long))
+
+        self.optimizer_sparse = None  # only with --sparse_emb, see setSparseOptimizer
 
         torch.manual_seed(args.seed)
         self.build_model()
         self.getCount()
+        # encoder -> policy -> decoding loop as one compiled region for training, graph breaks are allowed
+        self.forward = maybe_compile(self.forward, args)
+        # one decoder step of greedy and beam search; a bound method, so it is not registered as a submodule
+        self.decoder_step = maybe_compile(self.decoder.forward, args)
         try:
             assert self.args.beam_width > 0
             self.beam_search = True
@@ -603,26 +717,41 @@ class Model(nn.Module):
 
         self.global_step = 0
 
+    def prepare_for_inference(self):
+        """int8 dynamic quantization of the Linear/LSTM/GRU layers for cpu decoding, call after loadModel."""
+        if self.args.mode == 'train' or self.device.type != 'cpu':  # quantized kernels are cpu only
+            return self
+        types = {nn.Linear, nn.LSTM, nn.GRU}
+        # in place: the decoder may hold a compiled bound method that does not deep copy
+        self.encoder = torch.quantization.quantize_dynamic(self.encoder, types, dtype=torch.qint8, inplace=True)
+        self.policy = torch.quantization.quantize_dynamic(self.policy, types, dtype=torch.qint8, inplace=True)
+        if self.decoder.quantizable:
+            self.decoder = torch.quantization.quantize_dynamic(self.decoder, set(self.decoder.quantizable),
+                                                               dtype=torch.qint8, inplace=True)
+        return self
+
     def cuda_(self, var):
         return var.cuda() if self.args.cuda else var
 
     def build_model(self):
+        sparse = getattr(self.args, 'sparse_emb', False)  # embeddings get sparse gradients, see setOptimizers
         self.encoder = EncoderRNN(len(self.input_lang_index2word), self.emb_size, self.hid_size_enc,
-                                  self.cell_type, self.depth, self.dropout)
+                                  self.cell_type, self.depth, self.dropout, sparse=sparse)
 
         self.policy = policy.DefaultPolicy(self.hid_size_pol, self.hid_size_enc, self.db_size, self.bs_size)
 
         # pp added: intent_type branch
         if self.args.intent_type and self.args.use_moe_model:
             self.decoder = MoESeqAttnDecoderRNN(self.emb_size, self.hid_size_dec, len(self.output_lang_index2word),
-                                                self.cell_type, self.k, self.dropout, self.max_len, self.args)
+                                                self.cell_type, self.k, self.dropout, self.max_len, self.args,
+                                                sparse=sparse)
         elif self.use_attn:
             if self.attn_type == 'bahdanau':
                 self.decoder = SeqAttnDecoderRNN(self.emb_size, self.hid_size_dec, len(self.output_lang_index2word),
-                                                 self.cell_type, self.dropout, self.max_len)
+                                                 self.cell_type, self.dropout, self.max_len, sparse=sparse)
         else:
             self.decoder = DecoderRNN(self.emb_size, self.hid_size_dec, len(self.output_lang_index2word),
-                                      self.cell_type, self.dropout)
+                                      self.cell_type, self.dropout, sparse=sparse)
 
         if self.args.mode == 'train':
             self.gen_criterion = nn.NLLLoss(ignore_index=PAD_token,
@@ -640,56 +769,81 @@ class Model(nn.Module):
 
         proba = proba.view(-1, self.vocab_size)
 
-        self.gen_loss = self.gen_criterion(proba, target_tensor.view(-1))
-
         if self.args.use_moe_loss and mask_tensor is not None:  # data separate by intents:
-            gen_loss_list = []
-            for mask in mask_tensor:  # each intent has a mask [Batch, 1]
-                target_tensor_i = target_tensor.clone()
-                target_tensor_i = target_tensor_i.masked_fill_(mask, value=PAD_token)
-                loss_i = self.gen_criterion(proba, target_tensor_i.view(-1))
-                gen_loss_list.append(loss_i)
+            # one nll pass over [B*T,V]; the overall and every per-intent loss are masked means of it
+            token_nll = F.nll_loss(proba, target_tensor.view(-1), ignore_index=PAD_token,
+                                   reduction='none').view_as(target_tensor)  # [B, T], 0 on PAD
+            valid = target_tensor.ne(PAD_token)  # [B, T]
+            self.gen_loss = token_nll.sum() / valid.sum()
+            keep = valid & ~mask_tensor.bool()  # [K, B, T]; each intent has a mask [Batch, 1]
+            gen_losses = (token_nll * keep).sum((1, 2)) / keep.sum((1, 2)).clamp_min(1)  # [K]
 
             if self.args.learn_loss_weight:
-                gen_loss_list.append(self.gen_loss)
-                gen_loss_tensor = torch.as_tensor(torch.stack(gen_loss_list), device=self.device)
+                gen_loss_tensor = torch.cat((gen_losses, self.gen_loss.view(1)))
                 self.gen_loss = self.moe_loss_layer(gen_loss_tensor)
             else:  # hyper weights
                 # lambda_expert = 0.5
                 lambda_expert = self.args.lambda_expert
                 self.gen_loss = (1 - lambda_expert) * self.gen_loss + \
-                                lambda_expert * torch.mean(torch.tensor(gen_loss_list))
+                                lambda_expert * gen_losses.mean()  # keep the intent losses in the graph
+        else:
+            self.gen_loss = self.gen_criterion(proba, target_tensor.view(-1))
         self.loss = self.gen_loss
         self.loss.backward()
         grad = self.clipGradients()
         self.optimizer.step()
         self.optimizer.zero_grad()
+        if self.optimizer_sparse is not None:
+            self.optimizer_sparse.step()
+            self.optimizer_sparse.zero_grad()
 
         # self.printGrad()
         return self.loss.item(), 0, grad
 
+    def sparse_parameters(self):
+        """Embedding weights built with --sparse_emb, their gradients are sparse and only SparseAdam takes them."""
+        return [m.weight for m in self.modules() if isinstance(m, nn.Embedding) and m.sparse and m.weight.requires_grad]
+
+    def dense_parameters(self):
+        sparse = set(id(p) for p in self.sparse_parameters())
+        return [p for p in self.parameters() if p.requires_grad and id(p) not in sparse]
+
+    def setSparseOptimizer(self):
+        sparse = self.sparse_parameters()  # no weight decay here, SparseAdam does not support it
+        self.optimizer_sparse = optim.SparseAdam(lr=self.args.lr_rate, params=sparse) if sparse else None
+
     def setOptimizers(self):
         self.optimizer_policy = None
         if self.args.optim == 'sgd':
             self.optimizer = optim.SGD(lr=self.args.lr_rate,
-                                       params=filter(lambda x: x.requires_grad, self.parameters()),
+                                       params=self.dense_parameters(),
                                        weight_decay=self.args.l2_norm)
         elif self.args.optim == 'adadelta':
             self.optimizer = optim.Adadelta(lr=self.args.lr_rate,
-                                            params=filter(lambda x: x.requires_grad, self.parameters()),
+                                            params=self.dense_parameters(),
                                             weight_decay=self.args.l2_norm)
         elif self.args.optim == 'adam':
             self.optimizer = optim.Adam(lr=self.args.lr_rate,
-                                        params=filter(lambda x: x.requires_grad, self.parameters()),
+                                        params=self.dense_parameters(),
                                         weight_decay=self.args.l2_norm)
+        self.setSparseOptimizer()
+
+    def teacher_forcing_mask(self, target_length, target_tensor=None):
+        """Sample once per batch, on the device, at which steps the target word is fed as the next decoder input."""
+        if target_tensor is None:
+            return torch.zeros(target_length, dtype=torch.bool, device=self.device)
+        if self.teacher_forcing_ratio >= 1.0:  # default, do not consume the random state
+            return torch.ones(target_length, dtype=torch.bool, device=self.device)
+        return torch.rand(target_length, device=self.device) < self.teacher_forcing_ratio
 
     def retro_forward(self, input_tensor, input_lengths, target_tensor, target_lengths, db_tensor, bs_tensor,
-                      mask_tensor=None, if_detach=False):  # pp added: acts_list
+                      mask_tensor=None, if_detach=False, encoded=None):  # pp added: acts_list
         """Given the user sentence, user belief state and database pointer,
         encode the sentence, decide what policy vector construct and
         feed it as the first hiddent state to the decoder.
         input_tensor: tensor(batch, maxlen_input)
         target_tensor: tensor(batch, maxlen_target)
+        encoded: (encoder_outputs, encoder_hidden) if the caller already ran the encoder on input_tensor
         """
 
         target_length = target_tensor.size(1) if target_tensor is not None else self.args.max_len
@@ -698,8 +852,9 @@ class Model(nn.Module):
         batch_size, seq_len = input_tensor.size()
 
         # ENCODER
-        encoder_outputs, encoder_hidden = self.encoder(input_tensor,
-                                                       input_lengths)  # encoder_outputs: tensor(maxlen_input, batch, 150); encoder_hidden: tuple, each element is a tensor: [1, batch, 150]
+        if encoded is None:
+            encoded = self.encoder(input_tensor, input_lengths)
+        encoder_outputs, encoder_hidden = encoded  # encoder_outputs: tensor(maxlen_input, batch, 150); encoder_hidden: tuple, each element is a tensor: [1, batch, 150]
 
         # pp added: extract forward output of encoder if use SentMoE and 2 directions
         if self.num_directions == 2 and self.args.SentMoE:
@@ -718,39 +873,43 @@ class Model(nn.Module):
         # Teacher forcing: Feed the target as the next input
         # _, target_len = target_tensor.size()
 
-        decoder_input = torch.as_tensor([[SOS_token] for _ in range(batch_size)], dtype=torch.long,
-                                        device=self.device)  # tensor[batch, 1]
-        # decoder_input = torch.LongTensor([[SOS_token] for _ in range(batch_size)], device=self.device)
+        decoder_input = self.sos_input.expand(batch_size, 1)  # tensor[batch, 1]
 
-        # pp added: calculate new batch size
-        proba = torch.zeros(batch_size, target_length, self.vocab_size,
-                            device=self.device)  # tensor[Batch, maxlen_target, V]
-        hidd = torch.zeros(batch_size, target_length, self.hid_size_dec, device=self.device)
+        # if use SentMoE, we should stop teacher forcing for experts (target_tensor is None)
+        teacher_mask = self.teacher_forcing_mask(target_length, target_tensor)
+        self.decoder.prepare(encoder_outputs)  # attention keys are shared by all decoding steps
 
-        # generate target sequence step by step !!!
-        for t in range(target_length):
-            # pp added: moe chair
-            decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden, encoder_outputs,
-                                                          mask_tensor)  # decoder_output; decoder_hidden
+        if isinstance(self.decoder, SeqAttnDecoderRNN):  # the whole loop runs in TorchScript
+            proba, hidd, decoder_hidden = self.decoder.decode_sequence(decoder_input, decoder_hidden, encoder_outputs,
+                                                                       target_tensor, teacher_mask)
+        else:
+            # pp added: collect the steps and stack them once at the end
+            proba, hidd = [], []
+            # without targets teacher_mask is all False and these words are never picked
+            teacher_input = target_tensor if target_tensor is not None else \
+                self.sos_input.expand(batch_size, target_length)
 
-            # use_teacher_forcing = True if random.random() < self.args.teacher_ratio else False # pp added: self.args.SentMoE is False
-            # use_teacher_forcing = True if random.random() < self.args.teacher_ratio and self.args.SentMoE is False else False # pp added: self.args.SentMoE is False
-            if target_tensor is not None:  # if use SentMoE, we should stop teacher forcing for experts
-                decoder_input = target_tensor[:, t].view(-1, 1)  # [B,1] Teacher forcing
-            else:
-                # Without teacher forcing: use its own predictions as the next input
+            # generate target sequence step by step !!!
+            for t in range(target_length):
+                # pp added: moe chair
+                decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden, encoder_outputs,
+                                                              mask_tensor)  # decoder_output; decoder_hidden
+
+                # Teacher forcing where teacher_mask[t], else use its own predictions as the next input
                 topv, topi = decoder_output.topk(1)
                 # decoder_input = topi.squeeze().detach()  # detach from history as input
-                decoder_input = topi.detach()  # detach from history as input
+                decoder_input = torch.where(teacher_mask[t], teacher_input[:, t].view(-1, 1),
+                                            topi.detach())  # [B,1], detach from history as input
 
-            proba[:, t,
-            :] = decoder_output  # decoder_output[Batch, TargetVocab] # proba[Batch, Target_MaxLen, Target_Vocab]
-            # pp added
-            if isinstance(decoder_hidden, tuple):
-                hidd0 = decoder_hidden[0]
-            else:
-                hidd0 = decoder_hidden
-            hidd[:, t, :] = hidd0
+                proba.append(decoder_output)  # decoder_output[Batch, TargetVocab]
+                # pp added
+                if isinstance(decoder_hidden, tuple):
+                    hidd0 = decoder_hidden[0]
+                else:
+                    hidd0 = decoder_hidden
+                hidd.append(hidd0.squeeze(0))
+            proba = torch.stack(proba, dim=1)  # proba[Batch, Target_MaxLen, Target_Vocab]
+            hidd = torch.stack(hidd, dim=1)  # hidd[Batch, Target_MaxLen, H]
 
         decoded_sent = None
         # pp added: GENERATION
@@ -765,17 +924,18 @@ class Model(nn.Module):
 
         # if we consider sentence info
         if self.args.SentMoE:
+            # ENCODER, run once: the retrospective pass (forward direction, no targets) and the prospective pass
+            # below (backward direction, future info) differ only in policy and decoder, not in the encoding
+            encoded = self.encoder(input_tensor, input_lengths)
+            encoder_outputs, encoder_hidden = encoded  # encoder_outputs: tensor(maxlen_input, batch, 150); encoder_hidden: tuple, each element is a tensor: [1, batch, 150]
+
             proba_r, hidd, decoded_sent = self.retro_forward(input_tensor, input_lengths, None, None, db_tensor,
-                                                             bs_tensor, mask_tensor, if_detach=self.args.if_detach)
-            target_length = target_tensor.size(1)
+                                                             bs_tensor, mask_tensor, if_detach=self.args.if_detach,
+                                                             encoded=encoded)
 
             # for fixed encoding this is zero so it does not contribute
             batch_size, seq_len = input_tensor.size()
 
-            # ENCODER
-            encoder_outputs, encoder_hidden = self.encoder(input_tensor,
-                                                           input_lengths)  # encoder_outputs: tensor(maxlen_input, batch, 150); encoder_hidden: tuple, each element is a tensor: [1, batch, 150]
-
             # pp added: extract backward output of encoder
             if self.num_directions == 2:
                 if isinstance(encoder_hidden, tuple):
@@ -794,13 +954,12 @@ class Model(nn.Module):
             # Teacher forcing: Feed the target as the next input
             _, target_len = target_tensor.size()
 
-            decoder_input = torch.as_tensor([[SOS_token] for _ in range(batch_size)], dtype=torch.long,
-                                            device=self.device)  # tensor[batch, 1]
-            proba_p = torch.zeros(batch_size, target_length, self.vocab_size,
-                                  device=self.device)  # tensor[Batch, maxlen_target, V]
+            decoder_input = self.sos_input.expand(batch_size, 1)  # tensor[batch, 1]
+            proba_p = []  # stacked to tensor[Batch, maxlen_target, V] after the loop
 
             # pp added
             future_info = proba_r if self.args.future_info == 'proba' else hidd
+            self.decoder.prepare(encoder_outputs)
 
             # generate target sequence step by step !!!
             for t in range(target_len):
@@ -818,9 +977,9 @@ class Model(nn.Module):
                 #     # decoder_input = topi.squeeze().detach()  # detach from history as input
                 #     decoder_input = topi.detach()  # detach from history as input
 
-                proba_p[:, t, :] = decoder_output  # decoder_output[Batch, TargetVocab]
+                proba_p.append(decoder_output)  # decoder_output[Batch, TargetVocab]
 
-            return proba_p, None, decoded_sent
+            return torch.stack(proba_p, dim=1), None, decoded_sent
         else:
             # print('pretrain')
             proba_r, hidd, decoded_sent = self.retro_forward(input_tensor, input_lengths, target_tensor, target_lengths,
@@ -832,113 +991,36 @@ class Model(nn.Module):
                 mask_tensor=None):
         # pp added
         with torch.no_grad():
-            # ENCODER
-            encoder_outputs, encoder_hidden = self.encoder(input_tensor, input_lengths)
-
-            # POLICY
-            decoder_hidden = self.policy(encoder_hidden, db_tensor, bs_tensor, self.num_directions)
+            encoded = self.encode(input_tensor, input_lengths, db_tensor, bs_tensor)
 
             # GENERATION
-            decoded_words = self.decode(target_tensor, decoder_hidden, encoder_outputs, mask_tensor)
+            decoded_words = self.decode_from_encoded(encoded, target_tensor, mask_tensor)
 
         return decoded_words, 0
 
-    def decode(self, target_tensor, decoder_hidden, encoder_outputs, mask_tensor=None):
-        decoder_hiddens = decoder_hidden
-
-        if self.beam_search:  # wenqiang style - sequicity
-            decoded_sentences = []
-            for idx in range(target_tensor.size(0)):  # idx is the batch index
-
-                if isinstance(decoder_hiddens, tuple):  # LSTM case
-                    decoder_hidden = (
-                    decoder_hiddens[0][:, idx, :].unsqueeze(0), decoder_hiddens[1][:, idx, :].unsqueeze(0))
-                else:
-                    decoder_hidden = decoder_hiddens[:, idx, :].unsqueeze(0)
-                encoder_output = encoder_outputs[:, idx, :].unsqueeze(1)
-
-                # Beam start
-                self.topk = 1
-                endnodes = []  # stored end nodes
-                number_required = min((self.topk + 1), self.topk - len(endnodes))
-                decoder_input = torch.as_tensor([[SOS_token]], dtype=torch.long, device=self.device)
-                # decoder_input = torch.LongTensor([[SOS_token]], device=self.device)
-
-                # starting node hidden vector, prevNode, wordid, logp, leng,
-                node = BeamSearchNode(decoder_hidden, None, decoder_input, 0, 1)
-                nodes = PriorityQueue()  # start the queue
-                nodes.put((-node.eval(None, None, None, None),
-                           next(unique),
-                           node))
-
-                # start beam search
-                qsize = 1
-                while True:
-                    # give up when decoding takes too long
-                    if qsize > 2000: break
-
-                    # fetch the best node
-                    score, _, n = nodes.get()  # pp added: _
-                    decoder_input = n.wordid
-                    decoder_hidden = n.h
-
-                    if n.wordid.item() == EOS_token and n.prevNode != None:  # its not empty
-                        endnodes.append((score, n))
-                        # if reach maximum # of sentences required
-                        if len(endnodes) >= number_required:
-                            break
-                        else:
-                            continue
-
-                    # decode for one step using decoder
-                    # import pdb
-                    # pdb.set_trace()
-                    mask_tensor_idx = mask_tensor[:, idx, :].unsqueeze(1) if mask_tensor is not None else None
-                    decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden, encoder_output,
-                                                                  mask_tensor_idx)
-
-                    log_prob, indexes = torch.topk(decoder_output, self.args.beam_width)
-                    nextnodes = []
-
-                    for new_k in range(self.args.beam_width):
-                        decoded_t = indexes[0][new_k].view(1, -1)
-                        log_p = log_prob[0][new_k].item()
-
-                        node = BeamSearchNode(decoder_hidden, n, decoded_t, n.logp + log_p, n.leng + 1)
-                        score = -node.eval(None, None, None, None)
-                        nextnodes.append((score, node))
-
-                    # put them into queue
-                    for i in range(len(nextnodes)):
-                        score, nn = nextnodes[i]
-                        nodes.put((score,
-                                   next(unique),
-                                   nn))
-
-                    # increase qsize
-                    qsize += len(nextnodes)
-
-                # choose nbest paths, back trace them
-                if len(endnodes) == 0:
-                    endnodes = [(nodes.get()[0], nodes.get()[-1]) for n in range(self.topk)]
-
-                utterances = []
-                for score, n in sorted(endnodes, key=operator.itemgetter(0)):
-                    utterance = []
-                    utterance.append(n.wordid)
-                    # back trace
-                    while n.prevNode != None:
-                        n = n.prevNode
-                        utterance.append(n.wordid)
-
-                    utterance = utterance[::-1]
-                    utterances.append(utterance)
-
-                decoded_words = utterances[0]
-                decoded_sentence = [self.output_index2word(str(ind.item())) for ind in decoded_words]
-                # print(decoded_sentence)
-                decoded_sentences.append(' '.join(decoded_sentence[1:-1]))
+    def encode(self, input_tensor, input_lengths, db_tensor, bs_tensor):
+        """Encoder outputs and the first decoder hidden from the policy, can be decoded several times."""
+        # ENCODER
+        encoder_outputs, encoder_hidden = self.encoder(input_tensor, input_lengths)
 
+        # POLICY
+        decoder_hidden = self.policy(encoder_hidden, db_tensor, bs_tensor, self.num_directions)
+        return encoder_outputs, decoder_hidden
+
+    def decode_from_encoded(self, encoded, target_tensor, mask_tensor=None, beam_search=None):
+        """Decode the output of encode, with beam search or greedily (default: self.beam_search)."""
+        encoder_outputs, decoder_hidden = encoded
+        return self.decode(target_tensor, decoder_hidden, encoder_outputs, mask_tensor, beam_search)
+
+    def decode(self, target_tensor, decoder_hidden, encoder_outputs, mask_tensor=None, beam_search=None):
+        if beam_search is None:
+            beam_search = self.beam_search
+        if beam_search:  # batched beam search over all turns
+            beam_threshold = getattr(self.args, 'beam_threshold', float('inf'))
+            if beam_threshold != float('inf'):
+                return self.adaptive_beam_decode(decoder_hidden, encoder_outputs, target_tensor, mask_tensor,
+                                                 beam_threshold)
+            decoded_sentences = self.beam_decode(decoder_hidden, encoder_outputs, mask_tensor)
             return decoded_sentences
 
         else:  # GREEDY DECODING
@@ -946,35 +1028,184 @@ class Model(nn.Module):
             decoded_sentences = self.greedy_decode(decoder_hidden, encoder_outputs, target_tensor, mask_tensor)
             return decoded_sentences
 
+    def select_hidden(self, hidden, index):
+        # pick rows of the decoder hidden [1,B,H] (a tuple for lstm) along the batch dimension
+        if isinstance(hidden, tuple):
+            return tuple(x.index_select(1, index) for x in hidden)
+        return hidden.index_select(1, index)
+
+    def adaptive_beam_decode(self, decoder_hidden, encoder_outputs, target_tensor, mask_tensor, beam_threshold):
+        """Greedy decoding for the turns whose first word is clear, its log-probability beating the second best
+        by more than beam_threshold, and beam search for the others."""
+        batch_size = encoder_outputs.size(1)
+        self.decoder.prepare(encoder_outputs)
+        decoder_output, _ = self.decoder_step(self.sos_input.expand(batch_size, 1), decoder_hidden, encoder_outputs,
+                                              mask_tensor)
+        top2 = decoder_output.topk(2, dim=1)[0]
+        easy = (top2[:, 0] - top2[:, 1]) > beam_threshold
+
+        decoded_sentences = [None] * batch_size
+        for rows, beam_search in ((easy.nonzero().squeeze(-1), False), ((~easy).nonzero().squeeze(-1), True)):
+            if rows.numel() == 0:
+                continue
+            hidden = self.select_hidden(decoder_hidden, rows)
+            outputs = encoder_outputs.index_select(1, rows)
+            mask = mask_tensor.index_select(1, rows) if mask_tensor is not None else None
+            if beam_search:
+                sentences = self.beam_decode(hidden, outputs, mask)
+            else:
+                sentences = self.greedy_decode(hidden, outputs, target_tensor.index_select(0, rows), mask)
+            for row, sentence in zip(rows.tolist(), sentences):
+                decoded_sentences[row] = sentence
+        return decoded_sentences
+
+    def beam_decode(self, decoder_hidden, encoder_outputs, mask_tensor=None):
+        """Beam search with the (B, beam_width) hypotheses kept in tensors, so that every step is a single
+        decoder call over B*beam_width rows followed by a top-k over beam_width*V candidates per turn.
+        Hypotheses are ranked by their length normalised log-probability logp / (len - 1), len counting SOS.
+        A turn is done as soon as its best ranked hypothesis has ended, like the best-first search stopping
+        at the first EOS it pops, and done turns are dropped from the decoder batch.
+        """
+        beam_width = self.args.beam_width
+        batch_size = encoder_outputs.size(1)
+
+        # attention keys are projected once per turn
+        self.decoder.prepare(encoder_outputs)
+        # row b*beam_width+j of the decoder batch is hypothesis j of turn rows[b]
+        rows = torch.arange(batch_size, device=self.device)  # turns still being decoded
+        beam_idx = rows.repeat_interleave(beam_width)
+        # with grouped attention the beams of a turn share its encoder outputs and keys, else they are replicated
+        grouped = self.decoder.grouped_attention
+        if not grouped:
+            encoder_outputs = encoder_outputs.index_select(1, beam_idx)
+            self.decoder.select_prepared(beam_idx)
+        decoder_hidden = self.select_hidden(decoder_hidden, beam_idx)
+        if mask_tensor is not None:
+            mask_tensor = mask_tensor.index_select(1, beam_idx)
+        beam_range = torch.arange(beam_width, device=self.device)
+
+        decoder_input = self.sos_input.expand(batch_size * beam_width, 1)
+        # search state of all turns, [B, beam]; a done turn keeps its last values
+        scores = torch.zeros(batch_size, beam_width, device=self.device)
+        scores[:, 1:] = -float('inf')  # all hypotheses start from SOS, keep a single copy alive
+        lengths = torch.ones(batch_size, beam_width, device=self.device)  # words so far, SOS included
+        finished = torch.zeros(batch_size, beam_width, dtype=torch.bool, device=self.device)
+        # backpointers [max_len, B, beam]: the word of each hypothesis and the beam it extends,
+        # written in place for the live turns; done turns keep repeating EOS from the same beam
+        tokens = torch.full((self.max_len, batch_size, beam_width), EOS_token, dtype=torch.long, device=self.device)
+        parents = beam_range.expand(self.max_len, batch_size, beam_width).clone()
+        n_steps = 0
+        eos_only = None
+
+        for t in range(self.max_len):
+            n_rows = rows.size(0)
+            decoder_output, decoder_hidden = self.decoder_step(decoder_input, decoder_hidden, encoder_outputs, mask_tensor)
+            log_prob = decoder_output.view(n_rows, beam_width, -1)  # [b, beam, V]
+            vocab_size = log_prob.size(-1)
+
+            # a finished hypothesis keeps its score and can only be extended by EOS
+            if eos_only is None:
+                eos_only = torch.full((vocab_size,), -float('inf'), device=self.device)
+                eos_only[EOS_token] = 0
+            row_finished = finished.index_select(0, rows)
+            log_prob = torch.where(row_finished.unsqueeze(-1), eos_only, log_prob)
+
+            candidates = (scores.index_select(0, rows).unsqueeze(-1) + log_prob).view(n_rows, -1)  # [b, beam*V]
+            cand_lengths = lengths.index_select(0, rows) + (~row_finished).float()  # finished ones do not grow
+            normalised = candidates.view(n_rows, beam_width, -1) / (cand_lengths - 1 + 1e-6).unsqueeze(-1)
+            top_idx = normalised.view(n_rows, -1).topk(beam_width, dim=-1)[1]  # [b, beam], best first
+            parent = torch.div(top_idx, vocab_size, rounding_mode='floor')
+            token = torch.remainder(top_idx, vocab_size)
+
+            row_finished = row_finished.gather(1, parent) | (token == EOS_token)
+            scores = scores.index_copy(0, rows, candidates.gather(1, top_idx))
+            lengths = lengths.index_copy(0, rows, cand_lengths.gather(1, parent))
+            finished = finished.index_copy(0, rows, row_finished)
+            tokens[t].index_copy_(0, rows, token)
+            parents[t].index_copy_(0, rows, parent)
+            n_steps = t + 1
+
+            # no hypothesis can overtake an ended best one any more, stop decoding that turn
+            # nonzero is the only host sync of the step, the scores never leave the device
+            keep = (~row_finished[:, 0]).nonzero().squeeze(-1)
+            decoder_input = token.view(-1, 1)
+            parent_rows = (parent + (torch.arange(n_rows, device=self.device) * beam_width).unsqueeze(1)).view(-1)
+            if keep.numel() == n_rows:
+                decoder_hidden = self.select_hidden(decoder_hidden, parent_rows)
+                continue
+            if keep.numel() == 0:
+                break
+            rows = rows.index_select(0, keep)
+            kept = (keep.unsqueeze(1) * beam_width + beam_range).view(-1)  # decoder rows of the kept turns
+            decoder_input = decoder_input.index_select(0, kept)
+            decoder_hidden = self.select_hidden(decoder_hidden, parent_rows.index_select(0, kept))
+            encoder_rows = keep if grouped else kept
+            encoder_outputs = encoder_outputs.index_select(1, encoder_rows)
+            self.decoder.select_prepared(encoder_rows)
+            if mask_tensor is not None:
+                mask_tensor = mask_tensor.index_select(1, kept)
+
+        # choose the best path of each turn and follow the backpointers, all turns at once
+        beam = (scores / (lengths - 1 + 1e-6)).argmax(dim=1, keepdim=True)  # [B, 1]
+        path = torch.empty(batch_size, n_steps, dtype=torch.long, device=self.device)
+        for t in reversed(range(n_steps)):
+            path[:, t:t + 1] = tokens[t].gather(1, beam)
+            beam = parents[t].gather(1, beam)
+
+        return self.indices2sentences(path)
+
     def greedy_decode(self, decoder_hidden, encoder_outputs, target_tensor, mask_tensor=None):
-        decoded_sentences = []
+        """Greedy decoding, a turn leaves the decoder batch once it has emitted EOS and the loop stops
+        when no turn is left, instead of always running max_len steps."""
         batch_size, seq_len = target_tensor.size()
         # pp added
-        decoder_input = torch.as_tensor([[SOS_token] for _ in range(batch_size)], dtype=torch.long, device=self.device)
-        # decoder_input = torch.LongTensor([[SOS_token] for _ in range(batch_size)], device=self.device)
+        decoder_input = self.sos_input.expand(batch_size, 1)
 
-        decoded_words = torch.zeros((batch_size, self.max_len), device=self.device)
+        # ended turns are not written to any more, their EOS is what indices2sentences cuts at
+        decoded_words = torch.full((batch_size, self.max_len), EOS_token, dtype=torch.long, device=self.device)
+        rows = torch.arange(batch_size, device=self.device)  # turns still being decoded
+        n_steps = self.max_len
+        self.decoder.prepare(encoder_outputs)
         for t in range(self.max_len):
-            decoder_output, decoder_hidden = self.decoder(decoder_input, decoder_hidden, encoder_outputs, mask_tensor)
+            decoder_output, decoder_hidden = self.decoder_step(decoder_input, decoder_hidden, encoder_outputs, mask_tensor)
 
-            topv, topi = decoder_output.data.topk(1)  # get candidates
-            topi = topi.view(-1)
+            topi = decoder_output.argmax(dim=1)  # [B] word ids, no values tensor; decoding runs without grads
 
-            decoded_words[:, t] = topi
-            decoder_input = topi.detach().view(-1, 1)
+            decoded_words[:, t].index_copy_(0, rows, topi)
+            decoder_input = topi.view(-1, 1)  # a view, not a copy
 
-        for sentence in decoded_words:
+            finished = topi == EOS_token
+            if bool(finished.any()):  # drop the ended turns from the decoder batch
+                keep = (~finished).nonzero().squeeze(-1)
+                if keep.numel() == 0:
+                    n_steps = t + 1
+                    break
+                rows = rows.index_select(0, keep)
+                decoder_input = decoder_input.index_select(0, keep)
+                decoder_hidden = self.select_hidden(decoder_hidden, keep)
+                encoder_outputs = encoder_outputs.index_select(1, keep)
+                self.decoder.select_prepared(keep)
+                if mask_tensor is not None:
+                    mask_tensor = mask_tensor.index_select(1, keep)
+
+        return self.indices2sentences(decoded_words[:, :n_steps])
+
+    def indices2sentences(self, decoded_words):
+        """Sentences of a [B, T] tensor of word indices, each cut at its first EOS."""
+        output_words = self.output_words
+        decoded_sentences = []
+        for sentence in decoded_words.to('cpu', dtype=torch.long).tolist():  # a single device to host copy
             sent = []
             for ind in sentence:
-                if self.output_index2word(str(int(ind.item()))) == self.output_index2word(str(EOS_token)):
+                if ind == EOS_token:
                     break
-                sent.append(self.output_index2word(str(int(ind.item()))))
+                sent.append(output_words[ind])
             decoded_sentences.append(' '.join(sent))
 
         return decoded_sentences
 
     def clipGradients(self):
-        grad = torch.nn.utils.clip_grad_norm_(self.parameters(), self.args.clip)
+        grad = torch.nn.utils.clip_grad_norm_(self.dense_parameters(), self.args.clip)  # sparse grads are not clipped
         return grad
 
     def saveModel(self, iter):
@@ -996,45 +1227,36 @@ class Model(nn.Module):
         self.decoder.load_state_dict(torch.load(self.pre_model_dir + '/' + self.model_name + '-' + str(iter) + '.dec'))
 
     def input_index2word(self, index):
-        if index in self.input_lang_index2word:
+        try:
             return self.input_lang_index2word[index]
-        else:
+        except KeyError:
             raise UserWarning('We are using UNK')
 
     def output_index2word(self, index):
-        if index in self.output_lang_index2word:
+        try:
             return self.output_lang_index2word[index]
-        else:
+        except KeyError:
             raise UserWarning('We are using UNK')
 
     def input_word2index(self, index):
-        if index in self.input_lang_word2index:
-            return self.input_lang_word2index[index]
-        else:
-            return 2
+        return self.input_lang_word2index.get(index, 2)
 
     def output_word2index(self, index):
-        if index in self.output_lang_word2index:
-            return self.output_lang_word2index[index]
-        else:
-            return 2
+        return self.output_lang_word2index.get(index, 2)
 
     # pp added:
     def input_intent2index(self, intent):
-        if intent in self.intent2index:
-            return self.intent2index[intent]
-        else:
-            return 0
+        return self.intent2index.get(intent, 0)
 
     def input_index2intent(self, index):
-        if index in self.index2intent:
+        try:
             return self.index2intent[index]
-        else:
+        except KeyError:
             raise UserWarning('We are using UNK intent')
 
     def getCount(self):
         learnable_parameters = filter(lambda p: p.requires_grad, self.parameters())
-        param_cnt = sum([reduce((lambda x, y: x * y), param.shape) for param in learnable_parameters])
+        param_cnt = sum(param.numel() for param in learnable_parameters)
         print('Model has', param_cnt, ' parameters.')
 
     def printGrad(self):
@@ -4,9 +4,12 @@ from __future__ import division, print_function, unicode_literals
 
 import argparse
 import json
+import multiprocessing
 import os
 import shutil
 import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import torch
@@ -34,6 +37,12 @@ misc_arg.add_argument('--use_emb', type=str, default='False')
 misc_arg.add_argument('--seed', type=int, default=1, metavar='S', help='random seed (default: 1)')
 misc_arg.add_argument('--no_models', type=int, default=20, help='how many models to evaluate')
 misc_arg.add_argument('--beam_width', type=int, default=10, help='Beam width used in beamsearch')
+misc_arg.add_argument('--beam_threshold', type=float, default=float('inf'), help='decode greedily the turns whose top-1 first word beats the top-2 by more than this log-probability, inf always uses beam search')
+misc_arg.add_argument('--num_workers', type=int, default=1, help='checkpoints decoded in parallel processes, one gpu each when there are several')
+misc_arg.add_argument('--decode_batch_size', type=int, default=32, help='turns decoded together, bucketed by length across dialogues')
+misc_arg.add_argument('--amp', type=util.str2bool, nargs='?', const=True, default=False, help='bf16 autocast while decoding on cuda, check the scores against fp32 first')
+misc_arg.add_argument('--compile', type=util.str2bool, nargs='?', const=True, default=False, help='if True torch.compile the inference decoder step (torch>=2.0), regardless of the train config')
+misc_arg.add_argument('--quantize', type=util.str2bool, nargs='?', const=True, default=False, help='int8 dynamic quantization for cpu decoding')
 misc_arg.add_argument('--write_n_best', type=util.str2bool, nargs='?', const=True, default=False, help='Write n-best list (n=beam_width)')
 # 3. Here add new args
 new_arg = parser.add_argument_group('New')
@@ -63,107 +72,144 @@ def load_config(args):
     for key, value in args.__args.items():
         try:
             config[key] = value.value
-        except:
+        except AttributeError:
             config[key] = value
 
     return config
 
 
+# dictionaries and dialogues, the same for every checkpoint: loaded by the first loadData call of each process
+DATA = None
+
+
+def loadData():
+    global DATA
+    if DATA is None:
+        # Load dictionaries
+        dictionaries = util.loadDictionaries(mdir=args.data_dir)
+        # pp added: load intents
+        intents = util.loadIntentDictionaries(intent_type=args.intent_type, intent_file='{}/intents.json'.format(args.data_dir)) if args.intent_type else (None, None)
+        # # Load validation and test file list:
+        val_dials = util.loadJSON('{}/val_dials.json'.format(args.data_dir))
+        test_dials = util.loadJSON('{}/test_dials.json'.format(args.data_dir))
+        DATA = dictionaries, intents, val_dials, test_dials
+    return DATA
+
+
 def loadModelAndData(num):
-    # Load dictionaries
-    input_lang_index2word, output_lang_index2word, input_lang_word2index, output_lang_word2index = util.loadDictionaries(mdir=args.data_dir)
-    # pp added: load intents
-    intent2index, index2intent = util.loadIntentDictionaries(intent_type=args.intent_type, intent_file='{}/intents.json'.format(args.data_dir)) if args.intent_type else (None, None)
+    (input_lang_index2word, output_lang_index2word, input_lang_word2index, output_lang_word2index), \
+        (intent2index, index2intent), val_dials, test_dials = loadData()
 
     # Reload existing checkpoint
     model = Model(args, input_lang_index2word, output_lang_index2word, input_lang_word2index, output_lang_word2index, intent2index)
     model = model.to(detected_device)
     if args.load_param:
         model.loadModel(iter=num)
-
-    # # Load validation file list:
-    with open('{}/val_dials.json'.format(args.data_dir)) as outfile:
-        val_dials = json.load(outfile)
-    #
-    # # Load test file list:
-    with open('{}/test_dials.json'.format(args.data_dir)) as outfile:
-        test_dials = json.load(outfile)
+    if args.quantize:
+        model.prepare_for_inference()
+    model.eval()  # decoding only, whatever mode the config was saved with
 
     return model, val_dials, test_dials, input_lang_word2index, output_lang_word2index, intent2index, index2intent
 
 
-def decode(num=1, beam_search=False):
+# no autograd bookkeeping at all while decoding, torch.no_grad on versions without inference_mode
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
 
-    model, val_dials, test_dials, input_lang_word2index, output_lang_word2index, intent2index, index2intent  = loadModelAndData(num)
+# decoding modes run on every checkpoint: output suffix -> beam search or greedy
+MODES = (('gd', False), ('bm', True))
 
-    delex_path = '%s/delex.json' % args.data_dir
 
-    start_time = time.time()
-    model.beam_search = beam_search
-
-    step = 0 if not args.debug else 2 # small sample for debug
-
-    # VALIDATION
-    val_dials_gen = {}
-    valid_loss = 0
-    for name, val_file in list(val_dials.items())[-step:]:
-        loader = multiwoz_dataloader.get_loader_by_dialogue(val_file, name,
-                                                          input_lang_word2index, output_lang_word2index,
-                                                          args.intent_type, intent2index)
-        data = iter(loader).next()
+def decodeDials(model, dials, input_lang_word2index, output_lang_word2index, intent2index, step):
+    """Encode the turns of all dialogues in dials once, in batches of similar length across dialogues, and decode
+    them in all MODES, returns {suffix: {name: output_words}}."""
+    dials = dict(list(dials.items())[-step:])
+    loader, turns = multiwoz_dataloader.get_loader_by_length(dials, input_lang_word2index, output_lang_word2index,
+                                                             args.intent_type, intent2index,
+                                                             batch_size=args.decode_batch_size)
+    outputs = {suffix: [] for suffix, _ in MODES}  # in the order of turns
+    for data in loader:
         # Transfer to GPU
         if torch.cuda.is_available():
             data = [data[i].cuda() if isinstance(data[i], torch.Tensor) else data[i] for i in range(len(data))]
         input_tensor, input_lengths, target_tensor, target_lengths, bs_tensor, db_tensor, mask_tensor = data
 
-        output_words, loss_sentence = model.predict(input_tensor, input_lengths, target_tensor, target_lengths,
-                                                    db_tensor, bs_tensor, mask_tensor)
+        # the beam scores are summed in fp32, only the encoder and decoder matmuls run in bf16
+        with torch.autocast('cuda', dtype=torch.bfloat16, enabled=args.amp and torch.cuda.is_available()):
+            encoded = model.encode(input_tensor, input_lengths, db_tensor, bs_tensor)
+            for suffix, beam_search in MODES:
+                outputs[suffix].extend(model.decode_from_encoded(encoded, target_tensor, mask_tensor, beam_search))
 
-        valid_loss += loss_sentence
-        val_dials_gen[name] = output_words
+    # back to one list of output words per dialogue, in turn order
+    n_turns = {name: 0 for name in dials}
+    for name, _ in turns:
+        n_turns[name] += 1
+    dials_gen = {}
+    for suffix, _ in MODES:
+        dials_gen[suffix] = {name: [None] * n for name, n in n_turns.items()}
+        for (name, turn), output_words in zip(turns, outputs[suffix]):
+            dials_gen[suffix][name][turn] = output_words
+    return dials_gen
 
-    print('Current VALID LOSS:', valid_loss)
 
-    # Valid_Score = evaluateModel(val_dials_gen, val_dials, delex_path, mode='Valid')
-    Valid_Score = evaluator.summarize_report(val_dials_gen, mode='Valid')
-    # evaluteNLG(val_dials_gen, val_dials)
+def decode(num=1):
 
-    # TESTING
-    test_dials_gen = {}
-    test_loss = 0
-    for name, test_file in list(test_dials.items())[-step:]:
-        loader = multiwoz_dataloader.get_loader_by_dialogue(test_file, name,
-                                                          input_lang_word2index, output_lang_word2index,
-                                                          args.intent_type, intent2index)
-        data = iter(loader).next()
-        # Transfer to GPU
-        if torch.cuda.is_available():
-            data = [data[i].cuda() if isinstance(data[i], torch.Tensor) else data[i] for i in range(len(data))]
-        input_tensor, input_lengths, target_tensor, target_lengths, bs_tensor, db_tensor, mask_tensor = data
-        output_words, loss_sentence = model.predict(input_tensor, input_lengths, target_tensor, target_lengths,
-                                                    db_tensor, bs_tensor, mask_tensor)
-        test_loss += loss_sentence
-        test_dials_gen[name] = output_words
+    model, val_dials, test_dials, input_lang_word2index, output_lang_word2index, intent2index, index2intent  = loadModelAndData(num)
 
-    test_loss /= len(test_dials)
+    delex_path = '%s/delex.json' % args.data_dir
+
+    start_time = time.time()
+
+    step = 0 if not args.debug else 2 # small sample for debug
+
+    valid_loss, test_loss = 0, 0  # decoding computes no loss, see Model.predict
+
+    # VALIDATION
+    val_dials_gens = decodeDials(model, val_dials, input_lang_word2index, output_lang_word2index, intent2index, step)
+    print('Current VALID LOSS:', valid_loss)
 
+    # TESTING
+    test_dials_gens = decodeDials(model, test_dials, input_lang_word2index, output_lang_word2index, intent2index, step)
     print('Current TEST LOSS:', test_loss)
 
-    # Test_Score = evaluateModel(test_dials_gen, test_dials, delex_path, mode='Test')
-    Test_Score = evaluator.summarize_report(test_dials_gen, mode='Test')
-    # evaluteNLG(test_dials_gen, test_dials)
+    results = {}
+    for suffix, beam_search in MODES:
+        print('\n\n%s' % ('Beam Search' if beam_search else 'Greedy Search') + '=' * 50)
+        # Valid_Score = evaluateModel(val_dials_gen, val_dials, delex_path, mode='Valid')
+        Valid_Score = evaluator.summarize_report(val_dials_gens[suffix], mode='Valid')
+        # evaluteNLG(val_dials_gen, val_dials)
+        # Test_Score = evaluateModel(test_dials_gen, test_dials, delex_path, mode='Test')
+        Test_Score = evaluator.summarize_report(test_dials_gens[suffix], mode='Test')
+        # evaluteNLG(test_dials_gen, test_dials)
+        results[suffix] = (Valid_Score, val_dials_gens[suffix], np.exp(valid_loss),
+                           Test_Score, test_dials_gens[suffix], np.exp(test_loss))
 
     print('TIME:', time.time() - start_time)
-    return Valid_Score, val_dials_gen, np.exp(valid_loss), Test_Score, test_dials_gen, np.exp(test_loss)
+    return results
+
+
+def decodeCheckpoint(num):
+    print(30 * '-' + 'EVALUATING EPOCH %s' % num)
+    # args.model_path = args.model_path + '-' + str(ii)
+    with inference_mode():
+        return decode(num)
 
 
-def decodeWrapper(beam_search=False):
+def initWorker(parent_args, devices):
+    """Initializer of the --num_workers processes: the args of the parent, config included, and a gpu of their own."""
+    global evaluator
+    vars(args).update(parent_args)
+    if torch.cuda.is_available():
+        torch.cuda.set_device(devices.get())
+    evaluator = MultiWozEvaluator('MultiWozEvaluator')
+
+
+def decodeWrapper():
     # Load config file
     # with open(args.model_path + '.config') as f:
     with open('{}{}.config'.format(args.model_dir, args.model_name)) as f:
         add_args = json.load(f)
         for k, v in add_args.items():
-            if k=='data_dir': # ignore this arg
+            if k in ('data_dir', 'compile'): # ignore these args, compile is chosen at decode time
                 continue
             setattr(args, k, v)
 
@@ -174,63 +220,71 @@ def decodeWrapper(beam_search=False):
 
     # Start going through models
     # args.original = args.model_path
-    Best_Valid_Score = None
-    Best_Test_Score = None
-    Best_PPL = None
-    Best_model_id = 0
-    Best_val_dials_gen = {}
-    Best_test_dials_gen = {}
-    for ii in range(1, args.no_models + 1):
-        print(30 * '-' + 'EVALUATING EPOCH %s' % ii)
-        # args.model_path = args.model_path + '-' + str(ii)
-        with torch.no_grad():
-            Valid_Score, val_dials_gen, val_ppl, Test_Score, test_dials_gen, test_ppl = decode(ii, beam_search)
-            if Best_Valid_Score is None or Best_Valid_Score[-2] < Valid_Score[-2]:
-                Best_Valid_Score = Valid_Score
-                Best_Test_Score = Test_Score
-                Best_PPL = test_ppl
-                Best_val_dials_gen = val_dials_gen
-                Best_test_dials_gen = test_dials_gen
-                Best_model_id = ii
+    # greedy and beam search decode the same encodings, the best checkpoint is kept per mode
+    Best = {suffix: dict(Valid_Score=None, Test_Score=None, PPL=None, model_id=0, val_dials_gen={}, test_dials_gen={})
+            for suffix, _ in MODES}
+    checkpoints = range(1, args.no_models + 1)
+    if args.num_workers > 1:
+        # checkpoints are independent; spawn, not fork, as the children use cuda
+        ctx = multiprocessing.get_context('spawn')
+        devices = ctx.Queue()
+        for i in range(args.num_workers):
+            devices.put(i % max(torch.cuda.device_count(), 1))
+        pool = ProcessPoolExecutor(max_workers=args.num_workers, mp_context=ctx,
+                                   initializer=initWorker, initargs=(vars(args), devices))
+        all_results = pool.map(decodeCheckpoint, checkpoints)  # in checkpoint order
+    else:
+        pool = None
+        all_results = map(decodeCheckpoint, checkpoints)
+    for ii, results in zip(checkpoints, all_results):
+        for suffix, _ in MODES:
+            Valid_Score, val_dials_gen, val_ppl, Test_Score, test_dials_gen, test_ppl = results[suffix]
+            best = Best[suffix]
+            if best['Valid_Score'] is None or best['Valid_Score'][-2] < Valid_Score[-2]:
+                best.update(Valid_Score=Valid_Score, Test_Score=Test_Score, PPL=test_ppl, model_id=ii,
+                            val_dials_gen=val_dials_gen, test_dials_gen=test_dials_gen)
         # try:
         #     decode(ii, intent2index)
         # except:
         #     print('cannot decode')
-
-    # save best generated output to json
-    print('Summary'+'~'*50)
-    print('Best model: %s'%(Best_model_id))
-    BLEU, MATCHES, SUCCESS, SCORE, P, R, F1 = Best_Test_Score
-    mode = 'Test'
-    print('%s PPL: %.2f' % (mode, Best_PPL))
-    print('%s BLEU: %.4f' % (mode, BLEU))
-    print('%s Matches: %2.2f%%' % (mode, MATCHES))
-    print('%s Success: %2.2f%%' % (mode, SUCCESS))
-    print('%s Score: %.4f' % (mode, SCORE))
-    print('%s Precision: %.2f%%' % (mode, P))
-    print('%s Recall: %.2f%%' % (mode, R))
-    print('%s F1: %.2f%%' % (mode, F1))
-    suffix = 'bm' if beam_search else 'gd'
-    try:
-        with open(args.valid_output + 'val_dials_gen_%s.json' % suffix, 'w') as outfile:
-            json.dump(Best_val_dials_gen, outfile, indent=4)
-    except:
-        print('json.dump.err.valid')
-    try:
-        with open(args.decode_output + 'test_dials_gen_%s.json' % suffix, 'w') as outfile:
-            json.dump(Best_test_dials_gen, outfile, indent=4)
-    except:
-        print('json.dump.err.test')
+    if pool is not None:
+        pool.shutdown()
+
+    for suffix, beam_search in MODES:
+        best = Best[suffix]
+        # save best generated output to json
+        print('\n\n%s' % ('Beam Search' if beam_search else 'Greedy Search') + '=' * 50)
+        print('Summary'+'~'*50)
+        print('Best model: %s'%(best['model_id']))
+        BLEU, MATCHES, SUCCESS, SCORE, P, R, F1 = best['Test_Score']
+        mode = 'Test'
+        print('%s PPL: %.2f' % (mode, best['PPL']))
+        print('%s BLEU: %.4f' % (mode, BLEU))
+        print('%s Matches: %2.2f%%' % (mode, MATCHES))
+        print('%s Success: %2.2f%%' % (mode, SUCCESS))
+        print('%s Score: %.4f' % (mode, SCORE))
+        print('%s Precision: %.2f%%' % (mode, P))
+        print('%s Recall: %.2f%%' % (mode, R))
+        print('%s F1: %.2f%%' % (mode, F1))
+        try:
+            with open(args.valid_output + 'val_dials_gen_%s.json' % suffix, 'w') as outfile:
+                json.dump(best['val_dials_gen'], outfile, indent=4)
+        except (IOError, TypeError, ValueError):  # unwritable output dir or non serialisable outputs
+            traceback.print_exc()
+            print('json.dump.err.valid')
+        try:
+            with open(args.decode_output + 'test_dials_gen_%s.json' % suffix, 'w') as outfile:
+                json.dump(best['test_dials_gen'], outfile, indent=4)
+        except (IOError, TypeError, ValueError):
+            traceback.print_exc()
+            print('json.dump.err.test')
 
 if __name__ == '__main__':
     # create dir for generated outputs of valid and test set
     pp_mkdir(args.valid_output)
     pp_mkdir(args.decode_output)
     evaluator = MultiWozEvaluator('MultiWozEvaluator')
-    print('\n\nGreedy Search'+'='*50)
-    decodeWrapper(beam_search=False)
-    print('\n\nBeam Search' + '=' * 50)
-    decodeWrapper(beam_search=True)
+    decodeWrapper()  # greedy and beam search
     # evaluteNLGFile(gen_dials_fpath='results/bsl_20190510161309/data/test_dials/test_dials_gen.json',
     #                 ref_dialogues_fpath='data/test_dials.json')
     # evaluteNLGFiles(gen_dials_fpaths=['results/bsl_20190510161309/data/test_dials/test_dials_gen.json',
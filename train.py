@@ -106,6 +106,8 @@ new_arg.add_argument('--SentMoE', type=util.str2bool, nargs='?', const=True, def
 new_arg.add_argument('--if_detach', type=util.str2bool, nargs='?', const=True, default=False) # if detach expert parts
 new_arg.add_argument('--rp_share_rnn', type=util.str2bool, nargs='?', const=True, default=True) # if detach expert parts
 new_arg.add_argument('--future_info', type=str, default='proba') # use hidd or proba
+new_arg.add_argument('--sparse_emb', type=util.str2bool, nargs='?', const=True, default=False, help='if True embeddings get sparse gradients, updated by SparseAdam')
+new_arg.add_argument('--compile', type=util.str2bool, nargs='?', const=True, default=False, help='if True torch.compile the decoder step (torch>=2.0)')
 
 args = parser.parse_args()
 args.device = detected_device.type
@@ -178,8 +180,9 @@ def trainIters(model, intent2index, n_epochs=10, args=args):
         print_loss_total = 0; print_grad_total = 0; print_act_total = 0  # Reset every print_every
         start_time = datetime.datetime.now()
         # watch out where do you put it
-        model.optimizer = Adam(lr=args.lr_rate, params=filter(lambda x: x.requires_grad, model.parameters()), weight_decay=args.l2_norm)
+        model.optimizer = Adam(lr=args.lr_rate, params=model.dense_parameters(), weight_decay=args.l2_norm)
         model.optimizer_policy = Adam(lr=args.lr_rate, params=filter(lambda x: x.requires_grad, model.policy.parameters()), weight_decay=args.l2_norm)
+        model.setSparseOptimizer()  # embeddings with --sparse_emb
         # Training
         model.train()
         step = 0
@@ -39,31 +39,27 @@ class MultiwozSingleDataset(Dataset):
         return len(self.input_tensor)
 
     def input_word2index(self, index):
-        if index in self.src_word2id:
-            return self.src_word2id[index]
-        else:
-            return UNK_token
+        return self.src_word2id.get(index, UNK_token)
 
     def out_word2index(self, index):
-        if index in self.trg_word2id:
-            return self.trg_word2id[index]
-        else:
-            return UNK_token
+        return self.trg_word2id.get(index, UNK_token)
 
     def SingleDialogueJSON2Tensors(self):
         val_file = self.val_file
         input_tensor = []; target_tensor = []; bs_tensor = []; db_tensor = []; mask_tensor = []
+        # same lookups as self.input_word2index / out_word2index, without a method call per word
+        input_word2index, out_word2index = self.src_word2id.get, self.trg_word2id.get
         for idx, (usr, sys, bs, db, acts) in enumerate(
                 zip(val_file['usr'], val_file['sys'], val_file['bs'], val_file['db'], val_file['acts'])):
-            tensor = [self.input_word2index(word) for word in usr.strip(' ').split(' ')] + [EOS_token]  # models.input_word2index(word)
+            tensor = [input_word2index(word, UNK_token) for word in usr.strip(' ').split(' ')] + [EOS_token]  # models.input_word2index(word)
             input_tensor.append(torch.as_tensor(tensor, dtype=torch.long, device=self.device))  # .view(-1, 1))
 
-            tensor = [self.out_word2index(word) for word in sys.strip(' ').split(' ')] + [EOS_token]
+            tensor = [out_word2index(word, UNK_token) for word in sys.strip(' ').split(' ')] + [EOS_token]
             target_tensor.append(torch.as_tensor(tensor, dtype=torch.long, device=self.device))  # .view(-1, 1)
             # target_tensor.append(torch.LongTensor(tensor))  # .view(-1, 1)
 
-            bs_tensor.append([float(belief) for belief in bs])
-            db_tensor.append([float(pointer) for pointer in db])
+            bs_tensor.append(list(map(float, bs)))
+            db_tensor.append(list(map(float, db)))
 
             # pp added: mask_i=0 if i_th it contains i_th intent
             if self.intent2index:
@@ -130,6 +126,22 @@ def get_loader_by_dialogue(val_file, name, src_word2id, trg_word2id, intent_type
                              collate_fn=collate_fn)
     return data_loader
 
+def get_loader_by_length(dials, src_word2id, trg_word2id, intent_type=None, intent2index=None, batch_size=32):
+    '''Return a dataloader over the turns of all dialogues, batched by user utterance length across dialogues,
+    and the (name, turn index) of every turn in the order they are loaded'''
+    dataset_list, turns = [], []
+    for name, val_file in dials.items():
+        dataset = MultiwozSingleDataset(val_file, name, src_word2id, trg_word2id, intent_type, intent2index)
+        dataset_list.append(dataset)
+        turns.extend((name, i) for i in range(len(dataset)))
+    lengths = [len(input_tensor) for dataset in dataset_list for input_tensor in dataset.input_tensor]
+    order = sorted(range(len(turns)), key=lengths.__getitem__)  # similar lengths, little padding per batch
+    data_loader = DataLoader(dataset=ConcatDataset(dataset_list),
+                             batch_sampler=[order[i:i + batch_size] for i in range(0, len(order), batch_size)],
+                             num_workers=0,
+                             collate_fn=collate_fn)
+    return data_loader, [turns[i] for i in order]
+
 def get_loader_by_full_dialogue(file_path, src_word2id, trg_word2id, intent_type=None, intent2index=None):
     '''Return a list of dataloader, each one load a full dialogue data'''
     dials = json.load(open(file_path))
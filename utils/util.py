@@ -13,6 +13,10 @@ import torch
 import random
 import os
 import shutil
+try:  # optional, a faster json parser
+    import orjson
+except ImportError:
+    orjson = None
 
 # DEFINE special tokens
 SOS_token = 0
@@ -28,32 +32,34 @@ def padSequence(tensor, device=default_device):
     tensor_lengths = [len(sentence) for sentence in tensor]
     longest_sent = max(tensor_lengths)
     batch_size = len(tensor)
-    padded_tensor = torch.ones((batch_size, longest_sent), dtype=torch.int64, device=device) * pad_token
+    padded_tensor = torch.full((batch_size, longest_sent), pad_token, dtype=torch.long, device=device)
 
     # copy over the actual sequences
     for i, x_len in enumerate(tensor_lengths):
         sequence = tensor[i]
-        padded_tensor[i, 0:x_len] = sequence[:x_len]
+        padded_tensor[i, 0:x_len] = sequence[:x_len] if torch.is_tensor(sequence) else \
+            torch.as_tensor(sequence[:x_len], dtype=torch.long)
 
-    padded_tensor = torch.as_tensor(padded_tensor, dtype=torch.long, device=device)
     # padded_tensor = torch.LongTensor(padded_tensor)
     return padded_tensor, tensor_lengths
 
 
 def loadDialogue(model, val_file, input_tensor, target_tensor, bs_tensor, db_tensor, mask_tensor=None, intent2index=None, device=default_device):
+    # same lookups as models.input_word2index / output_word2index, without a method call per word
+    input_word2index, output_word2index = model.input_lang_word2index.get, model.output_lang_word2index.get
     # Iterate over dialogue
     for idx, (usr, sys, bs, db, acts) in enumerate(
             zip(val_file['usr'], val_file['sys'], val_file['bs'], val_file['db'], val_file['acts'])):
-        tensor = [model.input_word2index(word) for word in usr.strip(' ').split(' ')] + [EOS_token]  # models.input_word2index(word)
+        tensor = [input_word2index(word, UNK_token) for word in usr.strip(' ').split(' ')] + [EOS_token]  # models.input_word2index(word)
         input_tensor.append(torch.as_tensor(tensor, dtype=torch.long, device=device))  # .view(-1, 1))
         # input_tensor.append(torch.LongTensor(tensor))  # .view(-1, 1))
 
-        tensor = [model.output_word2index(word) for word in sys.strip(' ').split(' ')] + [EOS_token]
+        tensor = [output_word2index(word, UNK_token) for word in sys.strip(' ').split(' ')] + [EOS_token]
         target_tensor.append(torch.as_tensor(tensor, dtype=torch.long, device=device))  # .view(-1, 1)
         # target_tensor.append(torch.LongTensor(tensor))  # .view(-1, 1)
 
-        bs_tensor.append([float(belief) for belief in bs])
-        db_tensor.append([float(pointer) for pointer in db])
+        bs_tensor.append(list(map(float, bs)))
+        db_tensor.append(list(map(float, db)))
 
         # pp added: mask_i=0 if i_th it contains i_th intent
         if intent2index:
@@ -155,16 +161,20 @@ def init_seed(seed=None):
     torch.manual_seed(seed)
     random.seed(seed)
 
+def loadJSON(path):
+    # json.load of the file at path, parsed by orjson when it is installed
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path) as f:
+        return json.load(f)
+
 def loadDictionaries(mdir):
     # load data and dictionaries
-    with open('{}/input_lang.index2word.json'.format(mdir)) as f:
-        input_lang_index2word = json.load(f)
-    with open('{}/input_lang.word2index.json'.format(mdir)) as f:
-        input_lang_word2index = json.load(f)
-    with open('{}/output_lang.index2word.json'.format(mdir)) as f:
-        output_lang_index2word = json.load(f)
-    with open('{}/output_lang.word2index.json'.format(mdir)) as f:
-        output_lang_word2index = json.load(f)
+    input_lang_index2word = loadJSON('{}/input_lang.index2word.json'.format(mdir))
+    input_lang_word2index = loadJSON('{}/input_lang.word2index.json'.format(mdir))
+    output_lang_index2word = loadJSON('{}/output_lang.index2word.json'.format(mdir))
+    output_lang_word2index = loadJSON('{}/output_lang.word2index.json'.format(mdir))
 
 
     return input_lang_index2word, output_lang_index2word, input_lang_word2index, output_lang_word2index